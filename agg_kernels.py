@@ -0,0 +1,40 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba opcjonalna -> fallback na numpy
+    njit = None
+
+
+def _percentiles_np(a: np.ndarray, ps: np.ndarray) -> np.ndarray:
+    return np.percentile(a, ps)
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _percentiles_nb(a, ps):
+        """
+        Sortuje a w miejscu i liczy percentyle ps (0..100) interpolacją liniową,
+        tak samo jak aggregates_sessions._percentile.
+        """
+        a.sort()
+        n = a.size
+        out = np.empty(ps.size, dtype=np.float64)
+        for i in range(ps.size):
+            r = (ps[i] / 100.0) * (n - 1)
+            lo = int(r)
+            hi = min(lo + 1, n - 1)
+            frac = r - lo
+            out[i] = a[lo] * (1 - frac) + a[hi] * frac
+        return out
+
+
+def percentiles(a: np.ndarray, ps: np.ndarray) -> np.ndarray:
+    """
+    a: niepusta tablica float64 (może być nieposortowana; zostanie posortowana w miejscu)
+    ps: percentyle 0..100 jako float64
+    """
+    if njit is None:
+        return _percentiles_np(a, ps)
+    return _percentiles_nb(a, ps)
@@ -1,6 +1,16 @@
+import os
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import groupby, repeat
+from operator import itemgetter
 from typing import Iterable
 
+import numpy as np
+
+from agg_kernels import percentiles
+from db import open_conn, pack_latency_percentiles
+
 
 def _percentile(sorted_vals: list[float], p: float) -> float | None:
     """
@@ -21,6 +31,23 @@ def _percentile(sorted_vals: list[float], p: float) -> float | None:
     return float(sorted_vals[lo] * (1 - frac) + sorted_vals[hi] * frac)
 
 
+def _bucket_start(epoch: int) -> str:
+    """
+    Epoch bucketu -> 'YYYY-MM-DD HH:MM:SS' (UTC), ten sam format co datetime(..., 'unixepoch').
+    """
+    return datetime.fromtimestamp(int(epoch), tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _percentiles(vals: np.ndarray, ps: list[float]) -> list[float | None]:
+    """
+    Kilka percentyli naraz (jeden kernel: numba jeśli jest, inaczej numpy), ta sama interpolacja co _percentile.
+    Dla pustej tablicy -> None dla każdego p.
+    """
+    if vals.size == 0:
+        return [_percentile([], p) for p in ps]
+    return [float(x) for x in percentiles(vals, np.asarray(ps, dtype=np.float64))]
+
+
 def _normalize_session_ids(con: sqlite3.Connection, session_ids) -> list[int]:
     if session_ids is None or session_ids == []:
         rows = con.execute("SELECT session_id FROM analysis_sessions ORDER BY session_id ASC").fetchall()
@@ -30,31 +57,307 @@ def _normalize_session_ids(con: sqlite3.Connection, session_ids) -> list[int]:
     return [int(x) for x in session_ids]
 
 
-def _iter_raw_for_session(con: sqlite3.Connection, session_id: int) -> list[sqlite3.Row]:
-    return con.execute(
+# SQL upsertów jako stałe modułu: ten sam obiekt tekstu -> trafienie w cache statementów połączenia
+_UPSERT_SUMMARY = """
+INSERT INTO session_summary(
+  session_id, bucket_seconds,
+  total_requests, success_requests, success_rate,
+  status_2xx, status_4xx, status_5xx,
+  latency_avg, latency_percentiles,
+  ttfb_avg, ttfb_p95
+)
+VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+ON CONFLICT(session_id) DO UPDATE SET
+  bucket_seconds=excluded.bucket_seconds,
+  total_requests=excluded.total_requests,
+  success_requests=excluded.success_requests,
+  success_rate=excluded.success_rate,
+  status_2xx=excluded.status_2xx,
+  status_4xx=excluded.status_4xx,
+  status_5xx=excluded.status_5xx,
+  latency_avg=excluded.latency_avg,
+  latency_percentiles=excluded.latency_percentiles,
+  ttfb_avg=excluded.ttfb_avg,
+  ttfb_p95=excluded.ttfb_p95
+"""
+
+_UPSERT_EP = """
+INSERT INTO session_endpoint_summary(
+  session_id, endpoint, method,
+  count, success_rate, status_5xx,
+  latency_avg, latency_p95, latency_p99
+)
+VALUES (?,?,?,?,?,?,?,?,?)
+ON CONFLICT(session_id, endpoint, method) DO UPDATE SET
+  count=excluded.count,
+  success_rate=excluded.success_rate,
+  status_5xx=excluded.status_5xx,
+  latency_avg=excluded.latency_avg,
+  latency_p95=excluded.latency_p95,
+  latency_p99=excluded.latency_p99
+"""
+
+_UPSERT_TS = """
+INSERT INTO session_timeseries_summary(
+  session_id, bucket_seconds, bucket_start,
+  count, success_rate, status_5xx,
+  latency_avg, latency_p95
+)
+VALUES (?,?,?,?,?,?,?,?)
+ON CONFLICT(session_id, bucket_seconds, bucket_start) DO UPDATE SET
+  count=excluded.count,
+  success_rate=excluded.success_rate,
+  status_5xx=excluded.status_5xx,
+  latency_avg=excluded.latency_avg,
+  latency_p95=excluded.latency_p95
+"""
+
+FETCH_CHUNK = 10000
+
+
+def _fetch_floats(cur: sqlite3.Cursor) -> np.ndarray:
+    """
+    Jednokolumnowy wynik -> float64, strumieniowo paczkami fetchmany do bufora podwajanego w miarę potrzeby.
+    Bez listy wierszy dla całej sesji w pamięci.
+    """
+    cur.arraysize = FETCH_CHUNK
+    buf = np.empty(FETCH_CHUNK, dtype=np.float64)
+    n = 0
+    while chunk := cur.fetchmany():
+        m = len(chunk)
+        if n + m > buf.size:
+            buf = np.resize(buf, max(buf.size * 2, n + m))
+        buf[n:n + m] = np.fromiter((r[0] for r in chunk), dtype=np.float64, count=m)
+        n += m
+    return buf[:n]
+
+
+def _sorted_values(cur: sqlite3.Cursor, column: str) -> np.ndarray:
+    """
+    Niepuste wartości kolumny (latency_ms / ttfb_ms) z tmp_rr, posortowane rosnąco po stronie SQLite.
+    column pochodzi wyłącznie z kodu (nie od użytkownika).
+    """
+    cur.execute(
+        f"""
+        SELECT {column}
+        FROM temp.tmp_rr
+        WHERE {column} IS NOT NULL
+        ORDER BY {column} ASC
+        """
+    )
+    return _fetch_floats(cur)
+
+
+def _clear_session_aggregates(cur: sqlite3.Cursor, session_id: int, bucket_seconds: int) -> None:
+    cur.execute("DELETE FROM session_summary WHERE session_id=? AND bucket_seconds=?", (session_id, bucket_seconds))
+    cur.execute("DELETE FROM session_endpoint_summary WHERE session_id=?", (session_id,))
+    cur.execute(
+        "DELETE FROM session_timeseries_summary WHERE session_id=? AND bucket_seconds=?",
+        (session_id, bucket_seconds),
+    )
+
+
+def _session_rows(
+    cur: sqlite3.Cursor, sid: int, bucket_seconds: int
+) -> tuple[tuple, list[tuple], list[tuple]] | None:
+    """
+    Część read-only: liczy wiersze agregatów jednej sesji.
+    Zwraca (summary_row, ep_out, ts_out) albo None, gdy sesja nie ma danych RAW.
+
+    RAW sesji (JOIN z analysis_session_jobs) materializujemy RAZ do temp.tmp_rr (temp_store=MEMORY),
+    a summary / endpointy / timeseries czytają już tylko z niej.
+    """
+    cur.execute("DROP TABLE IF EXISTS temp.tmp_rr")
+    cur.execute(
         """
-        SELECT rr.*
+        CREATE TEMP TABLE tmp_rr AS
+        SELECT
+          rr.latency_ms,
+          rr.ttfb_ms,
+          rr.is_success,
+          rr.status_code,
+          rr.endpoint,
+          rr.method,
+          (rr.ts_epoch / ?) * ? AS b
         FROM request_results rr
         JOIN analysis_session_jobs sj ON sj.job_id = rr.job_id
         WHERE sj.session_id = ?
         """,
-        (session_id,),
+        (bucket_seconds, bucket_seconds, sid),
+    )
+    try:
+        return _session_rows_from_tmp(cur, sid, bucket_seconds)
+    finally:
+        cur.execute("DROP TABLE temp.tmp_rr")
+
+
+def _session_rows_from_tmp(
+    cur: sqlite3.Cursor, sid: int, bucket_seconds: int
+) -> tuple[tuple, list[tuple], list[tuple]] | None:
+    ep_out: list[tuple] = []
+    ts_out: list[tuple] = []
+
+    totals = cur.execute(
+        """
+        SELECT
+          COUNT(*) AS total,
+          SUM(CASE WHEN is_success=1 THEN 1 ELSE 0 END) AS success,
+          SUM(CASE WHEN status_code BETWEEN 200 AND 299 THEN 1 ELSE 0 END) AS status_2xx,
+          SUM(CASE WHEN status_code BETWEEN 400 AND 499 THEN 1 ELSE 0 END) AS status_4xx,
+          SUM(CASE WHEN status_code BETWEEN 500 AND 599 THEN 1 ELSE 0 END) AS status_5xx,
+          AVG(latency_ms) AS latency_avg,
+          AVG(ttfb_ms) AS ttfb_avg
+        FROM temp.tmp_rr
+        """
+    ).fetchone()
+
+    total, success, status_2xx, status_4xx, status_5xx, latency_avg, ttfb_avg = totals
+    if not total:
+        # brak danych RAW dla tej sesji -> pomijamy
+        return None
+
+    # percentyle z list już posortowanych przez SQLite
+    lat = _sorted_values(cur, "latency_ms")
+    ttfb = _sorted_values(cur, "ttfb_ms")
+
+    latency_p50, latency_p90, latency_p95, latency_p99 = _percentiles(lat, [50, 90, 95, 99])
+    (ttfb_p95,) = _percentiles(ttfb, [95])
+
+    success_rate = (success / total) if total else 0.0
+
+    summary_row = (
+        sid, bucket_seconds,
+        total, success, success_rate,
+        status_2xx, status_4xx, status_5xx,
+        latency_avg,
+        pack_latency_percentiles(latency_p50, latency_p90, latency_p95, latency_p99),
+        ttfb_avg, ttfb_p95,
+    )
+
+    # ---- endpoint_summary (per endpoint+method)
+    # liczniki i średnia z GROUP BY w SQLite
+    ep_totals = cur.execute(
+        """
+        SELECT
+          endpoint,
+          method,
+          COUNT(*) AS count,
+          SUM(CASE WHEN is_success=1 THEN 1 ELSE 0 END) * 1.0 / COUNT(*) AS success_rate,
+          SUM(CASE WHEN status_code BETWEEN 500 AND 599 THEN 1 ELSE 0 END) AS status_5xx,
+          AVG(latency_ms) AS latency_avg
+        FROM temp.tmp_rr
+        GROUP BY endpoint, method
+        """
     ).fetchall()
 
+    # p95/p99: jeden strumień latencji posortowany po (endpoint, method, latency)
+    ep_lat_rows = cur.execute(
+        """
+        SELECT endpoint, method, latency_ms
+        FROM temp.tmp_rr
+        WHERE latency_ms IS NOT NULL
+        ORDER BY endpoint, method, latency_ms
+        """
+    )
+    ep_pcts: dict[tuple[str, str], list[float | None]] = {}
+    for key, grp in groupby(ep_lat_rows, key=itemgetter(0, 1)):
+        lat2 = np.fromiter((latency_ms for _, _, latency_ms in grp), dtype=np.float64)
+        ep_pcts[key] = _percentiles(lat2, [95, 99])
+
+    for endpoint, method, cnt, sr, s5, lat_avg in ep_totals:
+        lat_p95, lat_p99 = ep_pcts.get((endpoint, method), (None, None))
+        ep_out.append((sid, endpoint, method, cnt, sr, s5, lat_avg, lat_p95, lat_p99))
+
+    # ---- timeseries (overall) — bucket b policzony w tmp_rr z ts_epoch
+    # liczniki i średnia z GROUP BY w SQLite (AVG jak w zapytaniu bazowym, te same wartości w PDF)
+    ts_totals = cur.execute(
+        """
+        SELECT
+          b,
+          COUNT(*) AS count,
+          SUM(CASE WHEN is_success=1 THEN 1 ELSE 0 END) * 1.0 / COUNT(*) AS success_rate,
+          SUM(CASE WHEN status_code BETWEEN 500 AND 599 THEN 1 ELSE 0 END) AS status_5xx,
+          AVG(latency_ms) AS latency_avg
+        FROM temp.tmp_rr
+        WHERE b IS NOT NULL
+        GROUP BY b
+        ORDER BY b ASC
+        """
+    ).fetchall()
 
-def _clear_session_aggregates(con: sqlite3.Connection, session_id: int, bucket_seconds: int) -> None:
-    con.execute("DELETE FROM session_summary WHERE session_id=? AND bucket_seconds=?", (session_id, bucket_seconds))
-    con.execute("DELETE FROM session_endpoint_summary WHERE session_id=?", (session_id,))
-    con.execute(
-        "DELETE FROM session_timeseries_summary WHERE session_id=? AND bucket_seconds=?",
-        (session_id, bucket_seconds),
+    # p95 per bucket: jeden strumień latencji posortowany po (bucket, latency)
+    # (liczymy w Pythonie, bo SQLite nie ma percentyla)
+    ts_lat_rows = cur.execute(
+        """
+        SELECT b, latency_ms
+        FROM temp.tmp_rr
+        WHERE b IS NOT NULL AND latency_ms IS NOT NULL
+        ORDER BY b, latency_ms
+        """
     )
+    ts_p95: dict[int, float | None] = {
+        b: _percentile([latency_ms for _, latency_ms in grp], 95)
+        for b, grp in groupby(ts_lat_rows, key=itemgetter(0))
+    }
+
+    for b, cnt, sr, s5, lat_avg in ts_totals:
+        ts_out.append((sid, bucket_seconds, _bucket_start(b), cnt, sr, s5, lat_avg, ts_p95.get(b)))
+
+    return summary_row, ep_out, ts_out
+
+
+def _write_session_rows(
+    cur: sqlite3.Cursor,
+    sid: int,
+    bucket_seconds: int,
+    summary_row: tuple,
+    ep_out: list[tuple],
+    ts_out: list[tuple],
+) -> None:
+    """
+    Część zapisu: krótka transakcja BEGIN IMMEDIATE (od razu blokada zapisu, bez SQLITE_BUSY przy upgrade).
+    """
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        _clear_session_aggregates(cur, sid, bucket_seconds)
+
+        # ---- session_summary UPSERT
+        cur.execute(_UPSERT_SUMMARY, summary_row)
+
+        # ---- session_endpoint_summary UPSERT
+        cur.executemany(_UPSERT_EP, ep_out)
+
+        # ---- session_timeseries_summary UPSERT
+        cur.executemany(_UPSERT_TS, ts_out)
+        cur.connection.commit()
+    except Exception:
+        cur.connection.rollback()
+        raise
+
+
+def _compute_sessions(db_path: str, sids: list[int], bucket_seconds: int) -> None:
+    """
+    Paczka sesji na jednym połączeniu i jednym kursorze (tak działa też w procesie z puli),
+    więc cache statementów połączenia trafia od drugiej sesji.
+    """
+    # bez row_factory: wiersze jako zwykłe krotki, rozpakowywane pozycyjnie (szybciej niż Row po nazwie)
+    con = open_conn(db_path)
+    con.row_factory = None
+    try:
+        cur = con.cursor()
+        for sid in sids:
+            rows = _session_rows(cur, sid, bucket_seconds)
+            if rows is not None:
+                _write_session_rows(cur, sid, bucket_seconds, *rows)
+    finally:
+        con.close()
 
 
 def compute_session_aggregates(
     db_path: str,
     session_ids: int | list[int] | None = None,
     bucket_seconds: int = 10,
+    max_workers: int | None = None,
 ) -> list[int]:
     """
     Liczy agregaty DLA SESJI (batch) na bazie request_results + analysis_session_jobs.
@@ -64,183 +367,24 @@ def compute_session_aggregates(
       - int -> jedna sesja
       - list[int] -> wiele sesji
 
+    max_workers: liczba procesów (None -> os.cpu_count()); sesje liczone równolegle,
+    paczka sesji na połączenie (WAL), zapis każdej sesji w osobnej krótkiej transakcji.
+
     Zwraca listę session_id, które policzono.
     """
-    con = sqlite3.connect(db_path)
-    con.row_factory = sqlite3.Row
+    con = open_conn(db_path)
     try:
         sids = _normalize_session_ids(con, session_ids)
-
-        for sid in sids:
-            rows = _iter_raw_for_session(con, sid)
-            if not rows:
-                # brak danych RAW dla tej sesji -> pomijamy
-                continue
-
-            _clear_session_aggregates(con, sid, bucket_seconds)
-
-            total = len(rows)
-            success = sum(1 for r in rows if int(r["is_success"]) == 1)
-
-            status_2xx = sum(1 for r in rows if 200 <= int(r["status_code"]) < 300)
-            status_4xx = sum(1 for r in rows if 400 <= int(r["status_code"]) < 500)
-            status_5xx = sum(1 for r in rows if 500 <= int(r["status_code"]) < 600)
-
-            lat = [float(r["latency_ms"]) for r in rows if r["latency_ms"] is not None]
-            ttfb = [float(r["ttfb_ms"]) for r in rows if r["ttfb_ms"] is not None]
-
-            lat.sort()
-            ttfb.sort()
-
-            latency_avg = (sum(lat) / len(lat)) if lat else None
-            ttfb_avg = (sum(ttfb) / len(ttfb)) if ttfb else None
-
-            latency_p50 = _percentile(lat, 50)
-            latency_p90 = _percentile(lat, 90)
-            latency_p95 = _percentile(lat, 95)
-            latency_p99 = _percentile(lat, 99)
-            ttfb_p95 = _percentile(ttfb, 95)
-
-            success_rate = (success / total) if total else 0.0
-
-            # ---- session_summary UPSERT
-            con.execute(
-                """
-                INSERT INTO session_summary(
-                  session_id, bucket_seconds,
-                  total_requests, success_requests, success_rate,
-                  status_2xx, status_4xx, status_5xx,
-                  latency_avg, latency_p50, latency_p90, latency_p95, latency_p99,
-                  ttfb_avg, ttfb_p95
-                )
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                ON CONFLICT(session_id) DO UPDATE SET
-                  bucket_seconds=excluded.bucket_seconds,
-                  total_requests=excluded.total_requests,
-                  success_requests=excluded.success_requests,
-                  success_rate=excluded.success_rate,
-                  status_2xx=excluded.status_2xx,
-                  status_4xx=excluded.status_4xx,
-                  status_5xx=excluded.status_5xx,
-                  latency_avg=excluded.latency_avg,
-                  latency_p50=excluded.latency_p50,
-                  latency_p90=excluded.latency_p90,
-                  latency_p95=excluded.latency_p95,
-                  latency_p99=excluded.latency_p99,
-                  ttfb_avg=excluded.ttfb_avg,
-                  ttfb_p95=excluded.ttfb_p95
-                """,
-                (
-                    sid, bucket_seconds,
-                    total, success, success_rate,
-                    status_2xx, status_4xx, status_5xx,
-                    latency_avg, latency_p50, latency_p90, latency_p95, latency_p99,
-                    ttfb_avg, ttfb_p95,
-                ),
-            )
-
-            # ---- endpoint_summary (per endpoint+method)
-            # grupowanie w Pythonie (szybkie na MVP)
-            by_ep: dict[tuple[str, str], list[sqlite3.Row]] = {}
-            for r in rows:
-                key = (str(r["endpoint"]), str(r["method"]))
-                by_ep.setdefault(key, []).append(r)
-
-            for (endpoint, method), grp in by_ep.items():
-                cnt = len(grp)
-                succ = sum(1 for r in grp if int(r["is_success"]) == 1)
-                sr = (succ / cnt) if cnt else 0.0
-                s5 = sum(1 for r in grp if 500 <= int(r["status_code"]) < 600)
-
-                lat2 = [float(r["latency_ms"]) for r in grp if r["latency_ms"] is not None]
-                lat2.sort()
-                lat_avg = (sum(lat2) / len(lat2)) if lat2 else None
-                lat_p95 = _percentile(lat2, 95)
-                lat_p99 = _percentile(lat2, 99)
-
-                con.execute(
-                    """
-                    INSERT INTO session_endpoint_summary(
-                      session_id, endpoint, method,
-                      count, success_rate, status_5xx,
-                      latency_avg, latency_p95, latency_p99
-                    )
-                    VALUES (?,?,?,?,?,?,?,?,?)
-                    ON CONFLICT(session_id, endpoint, method) DO UPDATE SET
-                      count=excluded.count,
-                      success_rate=excluded.success_rate,
-                      status_5xx=excluded.status_5xx,
-                      latency_avg=excluded.latency_avg,
-                      latency_p95=excluded.latency_p95,
-                      latency_p99=excluded.latency_p99
-                    """,
-                    (sid, endpoint, method, cnt, sr, s5, lat_avg, lat_p95, lat_p99),
-                )
-
-            # ---- timeseries (overall) — bucket po timestamp
-            # Uwaga: zakładam ISO timestamp; bucket robimy po sekundach: floor(epoch/bucket)*bucket
-            # Żeby nie robić parse datetime na każdym rekordzie (MVP), użyjemy SQL strftime('%s', ...)
-            ts_rows = con.execute(
-                """
-                SELECT
-                  datetime((strftime('%s', rr.timestamp) / ?) * ?, 'unixepoch') AS bucket_start,
-                  COUNT(*) AS count,
-                  AVG(rr.latency_ms) AS latency_avg,
-                  SUM(CASE WHEN rr.is_success=1 THEN 1 ELSE 0 END) * 1.0 / COUNT(*) AS success_rate,
-                  SUM(CASE WHEN rr.status_code BETWEEN 500 AND 599 THEN 1 ELSE 0 END) AS status_5xx
-                FROM request_results rr
-                JOIN analysis_session_jobs sj ON sj.job_id = rr.job_id
-                WHERE sj.session_id = ?
-                GROUP BY bucket_start
-                ORDER BY bucket_start ASC
-                """,
-                (bucket_seconds, bucket_seconds, sid),
-            ).fetchall()
-
-            # p95 w bucketach liczymy w Pythonie (bo SQLite nie ma percentyla)
-            for tr in ts_rows:
-                bucket_start = tr["bucket_start"]
-
-                bucket_lat = [
-                    float(r["latency_ms"]) for r in con.execute(
-                        """
-                        SELECT rr.latency_ms
-                        FROM request_results rr
-                        JOIN analysis_session_jobs sj ON sj.job_id = rr.job_id
-                        WHERE sj.session_id = ?
-                          AND datetime((strftime('%s', rr.timestamp) / ?) * ?, 'unixepoch') = ?
-                          AND rr.latency_ms IS NOT NULL
-                        """,
-                        (sid, bucket_seconds, bucket_seconds, bucket_start),
-                    ).fetchall()
-                ]
-                bucket_lat.sort()
-                bucket_p95 = _percentile(bucket_lat, 95)
-
-                con.execute(
-                    """
-                    INSERT INTO session_timeseries_summary(
-                      session_id, bucket_seconds, bucket_start,
-                      count, success_rate, status_5xx,
-                      latency_avg, latency_p95
-                    )
-                    VALUES (?,?,?,?,?,?,?,?)
-                    ON CONFLICT(session_id, bucket_seconds, bucket_start) DO UPDATE SET
-                      count=excluded.count,
-                      success_rate=excluded.success_rate,
-                      status_5xx=excluded.status_5xx,
-                      latency_avg=excluded.latency_avg,
-                      latency_p95=excluded.latency_p95
-                    """,
-                    (
-                        sid, bucket_seconds, bucket_start,
-                        int(tr["count"]), float(tr["success_rate"]), int(tr["status_5xx"]),
-                        None if tr["latency_avg"] is None else float(tr["latency_avg"]),
-                        bucket_p95,
-                    ),
-                )
-
-        con.commit()
-        return sids
     finally:
         con.close()
+
+    workers = min(max_workers or os.cpu_count() or 1, len(sids))
+    if workers <= 1:
+        _compute_sessions(db_path, sids, bucket_seconds)
+        return sids
+
+    # po jednej paczce sesji na proces
+    chunks = [sids[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(_compute_sessions, repeat(db_path), chunks, repeat(bucket_seconds)))
+    return sids
@@ -0,0 +1,178 @@
+import os
+import queue
+import sqlite3
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+# WAL + synchronous=NORMAL: commit nie robi fsync za każdym razem, odczyty idą równolegle z zapisem.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",   # 256 MB
+    "PRAGMA cache_size=-64000",     # ~64 MB
+    "PRAGMA busy_timeout=5000",     # ms
+)
+
+CACHED_STATEMENTS = 256   # domyślnie sqlite3 trzyma 128
+
+# Celowo stdlib sqlite3, nie APSW: reszta kodu opiera się na API DB-API sqlite3
+# (row_factory=sqlite3.Row, isolation_level / in_transaction, commit()/rollback(), cursor.description),
+# a APSW nie jest drop-in (inna semantyka transakcji i wierszy). Gorące ścieżki i tak idą przez
+# executemany na długo żyjących połączeniach z puli z dużym cache statementów (CACHED_STATEMENTS).
+
+
+def open_conn(db_path: str, readonly: bool = False, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Otwiera połączenie SQLite z ustawionymi PRAGMA pod ingest + raportowanie.
+
+    - isolation_level=None: sqlite3 nie otwiera transakcji niejawnie; pojedyncze instrukcje
+      commitują się same, wielo-instrukcyjne zapisy robią jawne BEGIN ... COMMIT
+    - row_factory=sqlite3.Row (kod liczący na krotkach ustawia row_factory=None u siebie)
+    - readonly=True -> PRAGMA query_only (np. generowanie PDF)
+    - check_same_thread=False dla połączeń z ConnectionPool (wydawane różnym wątkom)
+    - cached_statements: większy cache przygotowanych statementów (INSERT RAW, zapytania PDF,
+      agregacje) — połączenia z puli żyją długo, więc SQL kompiluje się raz
+    """
+    con = sqlite3.connect(
+        db_path,
+        isolation_level=None,
+        check_same_thread=check_same_thread,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    con.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    if readonly:
+        con.execute("PRAGMA query_only=1")
+    return con
+
+
+class ConnectionPool:
+    """
+    Pula połączeń na proces pod WAL: 1 writer + do N readerów (domyślnie N = liczba rdzeni).
+    Połączenia są otwierane leniwie (writer przy pierwszym acquire_writer, readery do limitu) i żyją
+    do końca procesu / close() — proces tylko czytający nie otwiera writera.
+
+    - acquire_writer(): transakcja BEGIN IMMEDIATE (blokada zapisu od razu, bez SQLITE_BUSY
+      przy eskalacji read -> write), commit przy wyjściu, rollback przy wyjątku
+    - acquire_reader(): połączenie z PRAGMA query_only; transakcję (snapshot) otwiera wołający
+    """
+
+    def __init__(self, db_path: str, readers: int | None = None):
+        self.db_path = db_path
+        self._max_readers = readers or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self._opened_readers = 0
+        self._readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+        self._writer_opened = False
+        self._writer: queue.Queue[sqlite3.Connection] = queue.Queue(maxsize=1)
+
+    @contextmanager
+    def acquire_writer(self) -> Iterator[sqlite3.Connection]:
+        con = self._get_writer()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+                con.commit()
+            except BaseException:
+                con.rollback()
+                raise
+        finally:
+            self._writer.put(con)
+
+    @contextmanager
+    def acquire_reader(self) -> Iterator[sqlite3.Connection]:
+        con = self._get_reader()
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            self._readers.put(con)
+
+    def _get_writer(self) -> sqlite3.Connection:
+        try:
+            return self._writer.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if not self._writer_opened:
+                self._writer_opened = True
+                return open_conn(self.db_path, check_same_thread=False)
+        return self._writer.get()
+
+    def _get_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened_readers < self._max_readers:
+                self._opened_readers += 1
+                return open_conn(self.db_path, readonly=True, check_same_thread=False)
+        return self._readers.get()
+
+    def close(self) -> None:
+        """
+        Zamyka połączenia aktualnie oddane do puli.
+        """
+        for q in (self._readers, self._writer):
+            while True:
+                try:
+                    q.get_nowait().close()
+                except queue.Empty:
+                    break
+
+
+# ---- pule per proces (po fork() połączeń rodzica nie wolno używać) ----
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+# Pule odziedziczone po fork(): odkładane zamiast _pools.clear(), żeby GC w dziecku nie zamknął
+# (sqlite3_close) połączeń rodzica. Dziecko otwiera własne przy pierwszym get_pool.
+_inherited_pools: list[ConnectionPool] = []
+
+
+def _after_fork_in_child() -> None:
+    global _pools_lock
+    _inherited_pools.extend(_pools.values())
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """
+    Zwraca pulę dla db_path w bieżącym procesie (tworzy przy pierwszym użyciu).
+    """
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(db_path)
+        return pool
+
+
+# session_summary.latency_percentiles: p50, p90, p95, p99 jako 4 x float64 (little-endian)
+_LATENCY_PERCENTILES = struct.Struct("<4d")
+
+
+def pack_latency_percentiles(p50, p90, p95, p99) -> bytes | None:
+    if p50 is None:
+        return None
+    return _LATENCY_PERCENTILES.pack(p50, p90, p95, p99)
+
+
+def unpack_latency_percentiles(blob: bytes | None) -> tuple:
+    """
+    -> (p50, p90, p95, p99); dla NULL -> same None.
+    """
+    if blob is None:
+        return (None, None, None, None)
+    return _LATENCY_PERCENTILES.unpack(blob)
@@ -1,5 +1,10 @@
-import sqlite3
-from typing import Any
+from operator import attrgetter
+from typing import Any, Iterable, Mapping
+
+import msgspec
+
+from db import ConnectionPool
+from storage import insert_raw_results, insert_raw_results_from_dicts, to_epoch_seconds
 
 
 REQUIRED_KEYS = [
@@ -11,48 +16,59 @@ REQUIRED_KEYS = [
 ]
 
 
+class JobDTO(msgspec.Struct):
+    """
+    DTO eventu requestu dekodowany wprost z JSON-a (walidacja + typy w jednym przejściu w C).
+    Wszystkie pola wymagane (jak REQUIRED_KEYS); null tylko tam, gdzie schema.sql dopuszcza NULL.
+    ts_epoch liczony przy dekodowaniu — błędny timestamp odrzuca tę wiadomość już w decode,
+    a nie dopiero INSERT całej paczki.
+    """
+    job_id: int
+    worker_id: int
+    timestamp: str
+    method: str
+    endpoint: str
+    status_code: int
+    latency_ms: float
+    ttfb_ms: float | None
+    response_size_bytes: int
+    error_msg: str | None
+    scenario_step: int
+    is_success: bool
+    ts_epoch: int = 0
+
+    def __post_init__(self) -> None:
+        self.ts_epoch = to_epoch_seconds(self.timestamp)
+
+
+# kolejność jak INSERT_SQL: pola DTO + ts_epoch
+_row_from_struct = attrgetter(*REQUIRED_KEYS, "ts_epoch")
+
+
 class JobRepository:
     """
     Repo zapisujące 'job' w Waszym rozumieniu = pojedynczy event requestu (DTO).
+    Pisze przez writera wstrzykniętej puli (zwykle db.get_pool(db_path)) — to samo połączenie
+    przez cały czas życia procesu, więc statement cache sqlite3 działa między wywołaniami.
     """
 
-    def __init__(self, db_path: str):
-        self.db_path = db_path
-
-    def insert_job(self, dto: dict[str, Any]) -> None:
-        # lekka walidacja
-        missing = [k for k in REQUIRED_KEYS if k not in dto]
-        if missing:
-            raise ValueError(f"Missing keys in DTO: {missing}")
-
-        con = sqlite3.connect(self.db_path)
-        try:
-            con.execute(
-                """
-                INSERT INTO request_results(
-                  job_id, worker_id, timestamp,
-                  method, endpoint, status_code,
-                  latency_ms, ttfb_ms,
-                  response_size_bytes, error_msg,
-                  scenario_step, is_success
-                )
-                VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
-                """,
-                (
-                    int(dto["job_id"]),
-                    int(dto["worker_id"]),
-                    str(dto["timestamp"]),
-                    str(dto["method"]),
-                    str(dto["endpoint"]),
-                    int(dto["status_code"]),
-                    None if dto["latency_ms"] is None else float(dto["latency_ms"]),
-                    None if dto["ttfb_ms"] is None else float(dto["ttfb_ms"]),
-                    None if dto["response_size_bytes"] is None else int(dto["response_size_bytes"]),
-                    dto["error_msg"],  # None albo string
-                    None if dto["scenario_step"] is None else int(dto["scenario_step"]),
-                    1 if bool(dto["is_success"]) else 0,
-                ),
-            )
-            con.commit()
-        finally:
-            con.close()
+    def __init__(self, pool: ConnectionPool):
+        self._pool = pool
+
+    def insert_job(self, dto: Mapping[str, Any]) -> None:
+        self.insert_many([dto])
+
+    def insert_many(self, dtos: Iterable[Mapping[str, Any]]) -> None:
+        """
+        Zapisuje wiele DTO w JEDNEJ transakcji writera (storage.insert_raw_results_from_dicts).
+        Błąd w którymkolwiek DTO -> rollback całej paczki.
+        """
+        with self._pool.acquire_writer() as con:
+            insert_raw_results_from_dicts(con, dtos)
+
+    def insert_structs(self, dtos: Iterable[JobDTO]) -> None:
+        """
+        Jak insert_many, ale dla już zdekodowanych JobDTO (bez walidacji kluczy i rzutowań per pole).
+        """
+        with self._pool.acquire_writer() as con:
+            insert_raw_results(con, map(_row_from_struct, dtos))
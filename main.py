@@ -1,11 +1,12 @@
 import os
 import sqlite3
-import json
-from datetime import datetime
+import orjson
 from aggregates_sessions import compute_session_aggregates
 from report_pdf import generate_pdf_for_sessions
 
-from storage import init_db, insert_raw_result
+from db import get_pool
+from storage import init_db
+from job_repo import JobRepository
 from session_repo import SessionRepository
 
 
@@ -17,8 +18,8 @@ SESSION_DESC = os.getenv("SESSION_DESC", "Local ingest test")
 SESSION_TOTAL_DEPTH = int(os.getenv("SESSION_TOTAL_DEPTH", "1"))
 
 def load_jobs(path: str) -> list[dict]:
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
     if not isinstance(data, list):
         raise ValueError("INPUT_JSON must contain a JSON array (list) of DTO objects")
     return data
@@ -29,21 +30,22 @@ def main() -> None:
 
     jobs = load_jobs(INPUT_JSON)
 
+    pool = get_pool(DB_PATH)
+    JobRepository(pool).insert_many(jobs)
+
     jobs_depth: dict[int, int] = {}
 
     for dto in jobs:
-        insert_raw_result(DB_PATH, dto)
-
         jid = int(dto["job_id"])
         jobs_depth[jid] = jobs_depth.get(jid, 0) + 1
 
-    repo = SessionRepository(DB_PATH)
+    repo = SessionRepository(pool)
     session_id = repo.create_session_with_jobs(
         description=SESSION_DESC,
         total_depth=SESSION_TOTAL_DEPTH,
         jobs_depth=jobs_depth,
         status="DONE",
-        started_at=datetime.now().isoformat(timespec="seconds"),
+        started_at=None,
     )
 
     print(f"[OK] Inserted RAW rows: {len(jobs)}")
@@ -1,13 +1,17 @@
+import multiprocessing
 import os
-import json
 import time
-import base64
+from concurrent.futures import ProcessPoolExecutor
+import msgspec
+import orjson
 import pika
 
-from storage import init_db, insert_raw_result
+from db import get_pool
+from storage import init_db
+from job_repo import JobDTO, JobRepository
 from session_repo import SessionRepository
 from aggregates_sessions import compute_session_aggregates
-from report_pdf import generate_pdf_for_sessions
+from report_pdf import generate_pdf_bytes
 
 
 # ====== Rabbit config ======
@@ -24,7 +28,13 @@ SUMMARY_KEY = os.getenv("SUMMARY_KEY", "analysis_start")
 DONE_QUEUE = os.getenv("DONE_QUEUE", "summary_done_queue")
 DONE_KEY = os.getenv("DONE_KEY", "analysis_done")
 
+REPORT_QUEUE = os.getenv("REPORT_QUEUE", "summary_report_queue")
+REPORT_KEY = os.getenv("REPORT_KEY", "analysis_report")   # surowy PDF (application/pdf)
+
 RAW_QUEUE = os.getenv("RAW_QUEUE", "perf.raw")
+RAW_BATCH_SIZE = int(os.getenv("RAW_BATCH_SIZE", "100"))   # ile wiadomości RAW na jeden zapis do DB
+RAW_PREFETCH = int(os.getenv("RAW_PREFETCH", "200"))       # niepotwierdzone wiadomości RAW w locie (>= RAW_BATCH_SIZE)
+RAW_FLUSH_SECONDS = float(os.getenv("RAW_FLUSH_SECONDS", "0.1"))
 
 
 # ====== DB / report config ======
@@ -36,6 +46,9 @@ TIMEOUT_SECONDS = float(os.getenv("ANALYSIS_TIMEOUT_SECONDS", "5.0"))
 REPORTS_DIR = os.getenv("REPORTS_DIR", "reports")
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "1"))                 # procesy budujące PDF
+PDF_POLL_SECONDS = float(os.getenv("PDF_POLL_SECONDS", "0.2"))   # co ile obsłużyć zdarzenia pika w trakcie budowy
+
 
 # ================= Rabbit helpers =================
 
@@ -43,7 +56,7 @@ def publish_done(ch, payload: dict):
     ch.basic_publish(
         exchange=SUMMARY_EXCHANGE,
         routing_key=DONE_KEY,
-        body=json.dumps(payload).encode(),
+        body=orjson.dumps(payload),
         properties=pika.BasicProperties(
             delivery_mode=2,           # trwała wiadomość
             content_type="application/json",
@@ -53,9 +66,30 @@ def publish_done(ch, payload: dict):
     print("[DONE] published")
 
 
+def publish_report_pdf(ch, pdf: bytes, session_id: int, filename: str):
+    """
+    PDF jako surowe bajty w body (bez base64 w JSON-ie); metadane w nagłówkach.
+    """
+    ch.basic_publish(
+        exchange=SUMMARY_EXCHANGE,
+        routing_key=REPORT_KEY,
+        body=pdf,
+        properties=pika.BasicProperties(
+            delivery_mode=2,
+            content_type="application/pdf",
+            headers={"session_id": session_id, "pdf_filename": filename},
+        )
+    )
+    print("[REPORT] published")
 
-def decode_raw_to_list(body: bytes) -> list[dict]:
-    msg = json.loads(body.decode())
+
+
+# pojedynczy DTO albo lista; strict=False -> te same luźne rzutowania co int()/float()/bool()
+RAW_DECODER = msgspec.json.Decoder(JobDTO | list[JobDTO], strict=False)
+
+
+def decode_raw_to_list(body: bytes) -> list[JobDTO]:
+    msg = RAW_DECODER.decode(body)
     return msg if isinstance(msg, list) else [msg]
 
 
@@ -70,7 +104,7 @@ def wait_for_analysis_start(ch) -> tuple[str, int]:
             continue
 
         try:
-            msg = json.loads(body.decode())
+            msg = orjson.loads(body)
             desc = str(msg.get("description", ""))
             total_depth = int(msg["totalDepth"])
             ch.basic_ack(method.delivery_tag)
@@ -89,6 +123,33 @@ def drain_raw_queue(ch):
             return
 
 
+# ================= PDF =================
+
+_pdf_executor: ProcessPoolExecutor | None = None
+
+
+def _get_pdf_executor() -> ProcessPoolExecutor:
+    global _pdf_executor
+    if _pdf_executor is None:
+        # spawn, nie fork: proces PDF nie dziedziczy otwartych połączeń SQLite ani socketu pika
+        _pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pdf_executor
+
+
+def build_pdf_in_background(ch, session_id: int) -> bytes:
+    """
+    Buduje PDF sesji w osobnym procesie (ReportLab jest CPU-bound i trzyma GIL).
+    W tym czasie połączenie pika dalej obsługuje heartbeaty / ramki brokera.
+    Proces roboczy (spawn) otwiera własną pulę i czyta bazę swoim readerem (db.get_pool).
+    """
+    fut = _get_pdf_executor().submit(generate_pdf_bytes, DB_PATH, session_id, BUCKET_SECONDS)
+    while not fut.done():
+        ch.connection.process_data_events(time_limit=PDF_POLL_SECONDS)
+    return fut.result()
+
+
 # ================= SESSION =================
 
 def finalize_session(ch, description, total_depth, jobs_depth):
@@ -101,7 +162,7 @@ def finalize_session(ch, description, total_depth, jobs_depth):
         })
         return
 
-    repo = SessionRepository(DB_PATH)
+    repo = SessionRepository(get_pool(DB_PATH))
     session_id = repo.create_session_with_jobs(
         description=description,
         total_depth=total_depth,
@@ -113,10 +174,17 @@ def finalize_session(ch, description, total_depth, jobs_depth):
     compute_session_aggregates(DB_PATH, session_ids=session_id, bucket_seconds=BUCKET_SECONDS)
 
     out_pdf = os.path.join(REPORTS_DIR, f"raport_session_{session_id}.pdf")
-    generate_pdf_for_sessions(DB_PATH, session_id, out_pdf, BUCKET_SECONDS)
 
-    with open(out_pdf, "rb") as f:
-        pdf = f.read()
+    # PDF budowany w pamięci: zapis na dysk + publikacja tych samych bajtów (bez ponownego odczytu pliku)
+    pdf = build_pdf_in_background(ch, session_id)
+
+    with open(out_pdf, "wb") as f:
+        f.write(pdf)
+
+    pdf_filename = os.path.basename(out_pdf)
+
+    # najpierw PDF, potem DONE — odbiorca DONE ma już raport na REPORT_KEY
+    publish_report_pdf(ch, pdf, session_id, pdf_filename)
 
     publish_done(ch, {
         "event": "analysis_done",
@@ -125,56 +193,113 @@ def finalize_session(ch, description, total_depth, jobs_depth):
         "session_id": session_id,
         "jobs_count": len(jobs_depth),
         "totalDepth": total_depth,
-        "pdf_filename": os.path.basename(out_pdf),
+        "pdf_filename": pdf_filename,
         "pdf_size_bytes": len(pdf),
-        "pdf_b64": base64.b64encode(pdf).decode()
+        "pdf_routing_key": REPORT_KEY
     })
 
 
-def consume_raw_for_one_session(ch, description, total_depth):
+def flush_raw_batch(ch, repo: JobRepository, batch: list[tuple[int, list[JobDTO]]]) -> list[list[JobDTO]]:
+    """
+    batch: [(delivery_tag, DTO z tej wiadomości), ...] w kolejności odbioru.
+    Zapisuje paczkę jedną transakcją i potwierdza wszystkie wiadomości do ostatniego tagu (multiple=True).
+    Gdy transakcja padnie (np. wiersz łamiący NOT NULL), zapisuje wiadomości po jednej:
+    ack dla zapisanych, nack (bez requeue) tylko dla błędnych.
+    Zwraca DTO odrzuconych wiadomości (po liście na wiadomość).
+    """
+    try:
+        repo.insert_structs(dto for _, dtos in batch for dto in dtos)
+    except Exception as e:
+        print("[RAW] batch insert failed, retrying per message:", e)
+    else:
+        ch.basic_ack(batch[-1][0], multiple=True)
+        return []
+
+    rejected = []
+    for tag, dtos in batch:
+        try:
+            repo.insert_structs(dtos)
+        except Exception as e:
+            print("[RAW] bad msg:", e)
+            ch.basic_nack(tag, requeue=False)
+            rejected.append(dtos)
+            continue
+        ch.basic_ack(tag)
+    return rejected
+
+
+def _add_depth(jobs_depth: dict, dtos: list[JobDTO], delta: int) -> None:
+    """
+    +1 / -1 do depth każdego joba z wiadomości; job z depth 0 znika ze słownika.
+    """
+    for jid in {x.job_id for x in dtos}:
+        depth = jobs_depth.get(jid, 0) + delta
+        if depth:
+            jobs_depth[jid] = depth
+        else:
+            del jobs_depth[jid]
+
+
+def consume_raw_for_one_session(ch, repo: JobRepository, description, total_depth):
     jobs_depth = {}
     last_msg = time.monotonic()
+    last_flush = last_msg
 
-    print("[RAW] collecting...")
+    # paczka: (delivery_tag, DTO) wiadomości jeszcze niezapisanych / niepotwierdzonych
+    batch = []
 
-    while True:
-        method, props, body = ch.basic_get(queue=RAW_QUEUE, auto_ack=False)
+    print("[RAW] collecting...")
 
+    # broker wypycha do RAW_PREFETCH wiadomości naraz; (None, None, None) po RAW_FLUSH_SECONDS ciszy
+    for method, props, body in ch.consume(
+        RAW_QUEUE, auto_ack=False, inactivity_timeout=RAW_FLUSH_SECONDS
+    ):
         now = time.monotonic()
 
-        # inactivity timeout
-        if not method:
-            if now - last_msg > TIMEOUT_SECONDS:
-                print("[RAW] timeout")
-                finalize_session(ch, description, total_depth, jobs_depth)
-                drain_raw_queue(ch)
-                return
-            time.sleep(0.2)
-            continue
-
-        try:
-            dtos = decode_raw_to_list(body)
+        if method:
+            try:
+                dtos = decode_raw_to_list(body)
+            except Exception as e:
+                print("[RAW] bad msg:", e)
+                ch.basic_nack(method.delivery_tag, requeue=False)
+                continue
 
-            for dto in dtos:
-                insert_raw_result(DB_PATH, dto)
+            batch.append((method.delivery_tag, dtos))
+            _add_depth(jobs_depth, dtos, +1)
+            last_msg = now
 
-            for jid in {int(x["job_id"]) for x in dtos}:
-                jobs_depth[jid] = jobs_depth.get(jid, 0) + 1
+            # depth liczony per wiadomość: wiadomość domykająca sesję kończy paczkę, a kolejne
+            # (jeszcze niepotwierdzone) zostają dla ch.cancel() / drain_raw_queue, jak przy zapisie per wiadomość
+            complete = bool(jobs_depth) and all(v >= total_depth for v in jobs_depth.values())
 
-            ch.basic_ack(method.delivery_tag)
-            last_msg = now
+            # paczka niepełna, nie minął interwał zapisu i sesja niedomknięta -> zbieramy dalej
+            if not complete and len(batch) < RAW_BATCH_SIZE and now - last_flush < RAW_FLUSH_SECONDS:
+                continue
 
+        # paczka pełna, minął interwał, sesja domknięta albo kolejka chwilowo pusta -> zapis
+        if batch:
+            # depth tylko z wiadomości faktycznie zapisanych: odrzucone się nie liczą
+            for dtos in flush_raw_batch(ch, repo, batch):
+                _add_depth(jobs_depth, dtos, -1)
             print(f"[RAW] jobs={jobs_depth}")
 
+            batch = []
+            last_flush = now
+
             if jobs_depth and all(v >= total_depth for v in jobs_depth.values()):
                 print("[RAW] depth complete")
-                finalize_session(ch, description, total_depth, jobs_depth)
-                drain_raw_queue(ch)
-                return
+                break
+            continue
 
-        except Exception as e:
-            print("[RAW] bad msg:", e)
-            ch.basic_nack(method.delivery_tag, requeue=False)
+        # inactivity timeout
+        if now - last_msg > TIMEOUT_SECONDS:
+            print("[RAW] timeout")
+            break
+
+    # oddaje do kolejki wiadomości pobrane z wyprzedzeniem (i tak lecą do drain)
+    ch.cancel()
+    finalize_session(ch, description, total_depth, jobs_depth)
+    drain_raw_queue(ch)
 
 
 # ================= main =================
@@ -187,7 +312,7 @@ def main():
         pika.ConnectionParameters(RABBIT_HOST, RABBIT_PORT, credentials=creds, heartbeat=60)
     )
     ch = conn.channel()
-    ch.basic_qos(prefetch_count=1)
+    ch.basic_qos(prefetch_count=RAW_PREFETCH)   # dotyczy konsumenta RAW (basic_get go nie używa)
     ch.confirm_delivery()   # publisher confirms
 
     # exchange
@@ -202,9 +327,17 @@ def main():
     ch.queue_bind(queue=DONE_QUEUE, exchange=SUMMARY_EXCHANGE, routing_key=DONE_KEY)
     print(f"[INFO] DONE queue '{DONE_QUEUE}' bound to {SUMMARY_EXCHANGE}:{DONE_KEY}")
 
+    # REPORT queue (PDF)
+    ch.queue_declare(queue=REPORT_QUEUE, durable=True)
+    ch.queue_bind(queue=REPORT_QUEUE, exchange=SUMMARY_EXCHANGE, routing_key=REPORT_KEY)
+    print(f"[INFO] REPORT queue '{REPORT_QUEUE}' bound to {SUMMARY_EXCHANGE}:{REPORT_KEY}")
+
     # RAW queue
     ch.queue_declare(queue=RAW_QUEUE, durable=True)
 
+    # zapis RAW przez writera z puli procesu (jedno połączenie na cały czas życia workera)
+    repo = JobRepository(get_pool(DB_PATH))
+
     print("=== ANALYSIS WORKER READY ===")
 
     while True:
@@ -212,7 +345,7 @@ def main():
         print(f"[START] {desc} depth={td}")
 
         drain_raw_queue(ch)
-        consume_raw_for_one_session(ch, desc, td)
+        consume_raw_for_one_session(ch, repo, desc, td)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
-import sqlite3
-from datetime import datetime
+import io
+import time
+from typing import BinaryIO
 
+import orjson
 from reportlab.platypus import (
     SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
 )
@@ -11,17 +13,215 @@ from reportlab.lib.units import mm
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
+from db import get_pool, unpack_latency_percentiles
+
 FONT = "fonts/DejaVuSans.ttf"
 FONT_BOLD = "fonts/DejaVuSans-Bold.ttf"
 
-
-def _fetch_one(con, sql, args=()):
-    row = con.execute(sql, args).fetchone()
-    return dict(row) if row else None
+# ---- zapytania raportu ----
+# Stałe modułu: ten sam tekst SQL przy każdym raporcie -> trafienie w cache statementów sqlite3
+# (open_conn: cached_statements). Lista sesji idzie jednym parametrem jako tablica JSON
+# (json_each, wbudowane w SQLite >= 3.38), więc tekst SQL nie zależy od liczby sesji.
+_SQL_ALL_SESSION_IDS = "SELECT session_id FROM analysis_sessions ORDER BY session_id ASC"
+
+# jawne listy kolumn: tylko to, co renderuje _render_single_session (+ session_id do grupowania)
+_SQL_SESSIONS = """
+SELECT session_id, started_at, description, total_depth, status
+FROM analysis_sessions
+WHERE session_id IN (SELECT value FROM json_each(?))
+"""
+
+_SQL_SUMMARY = """
+SELECT
+  session_id,
+  total_requests, success_requests, success_rate,
+  status_2xx, status_4xx, status_5xx,
+  latency_avg, latency_percentiles,
+  ttfb_avg, ttfb_p95
+FROM session_summary
+WHERE session_id IN (SELECT value FROM json_each(?))
+"""
+
+_SQL_ENDPOINTS = """
+SELECT session_id, endpoint, method, count, success_rate, latency_p95, status_5xx
+FROM session_endpoint_summary
+WHERE session_id IN (SELECT value FROM json_each(?))
+ORDER BY session_id, latency_p95 DESC
+"""
+
+_SQL_TIMESERIES = """
+SELECT session_id, bucket_start, count, success_rate, latency_avg, latency_p95, status_5xx
+FROM session_timeseries_summary
+WHERE session_id IN (SELECT value FROM json_each(?))
+  AND bucket_seconds=?
+ORDER BY session_id, bucket_start ASC
+"""
+
+# Fallback dla sesji bez policzonych agregatów: liczone w SQLite z RAW, tylko dla sesji z listy
+# (filtr w CTE rr -> wyszukiwanie po indeksach, bez skanu całego RAW).
+# Percentyle: interpolacja liniowa jak aggregates_sessions._percentile
+#   r = p * (n-1), lo = floor(r), f = r - lo  ->  v[lo] * (1-f) + v[lo+1] * f
+# (rn = pozycja 0..n-1 w posortowanej grupie, last = n-1)
+_SQL_SUMMARY_LIVE = """
+WITH rr AS (
+  SELECT sj.session_id, r.latency_ms, r.ttfb_ms, r.is_success, r.status_code
+  FROM analysis_session_jobs sj
+  JOIN request_results r ON r.job_id = sj.job_id
+  WHERE sj.session_id IN (SELECT value FROM json_each(?))
+),
+lat AS (
+  SELECT session_id, latency_ms AS v,
+         ROW_NUMBER() OVER w - 1 AS rn,
+         COUNT(*) OVER (PARTITION BY session_id) - 1 AS last
+  FROM rr
+  WHERE latency_ms IS NOT NULL
+  WINDOW w AS (PARTITION BY session_id ORDER BY latency_ms)
+),
+lat_p AS (
+  SELECT session_id,
+    SUM(CASE rn
+          WHEN CAST(last * 0.95 AS INTEGER) THEN v * (1 - (last * 0.95 - CAST(last * 0.95 AS INTEGER)))
+          WHEN CAST(last * 0.95 AS INTEGER) + 1 THEN v * (last * 0.95 - CAST(last * 0.95 AS INTEGER))
+        END) AS p95,
+    SUM(CASE rn
+          WHEN CAST(last * 0.99 AS INTEGER) THEN v * (1 - (last * 0.99 - CAST(last * 0.99 AS INTEGER)))
+          WHEN CAST(last * 0.99 AS INTEGER) + 1 THEN v * (last * 0.99 - CAST(last * 0.99 AS INTEGER))
+        END) AS p99
+  FROM lat
+  GROUP BY session_id
+),
+ttfb AS (
+  SELECT session_id, ttfb_ms AS v,
+         ROW_NUMBER() OVER w - 1 AS rn,
+         COUNT(*) OVER (PARTITION BY session_id) - 1 AS last
+  FROM rr
+  WHERE ttfb_ms IS NOT NULL
+  WINDOW w AS (PARTITION BY session_id ORDER BY ttfb_ms)
+),
+ttfb_p AS (
+  SELECT session_id,
+    SUM(CASE rn
+          WHEN CAST(last * 0.95 AS INTEGER) THEN v * (1 - (last * 0.95 - CAST(last * 0.95 AS INTEGER)))
+          WHEN CAST(last * 0.95 AS INTEGER) + 1 THEN v * (last * 0.95 - CAST(last * 0.95 AS INTEGER))
+        END) AS p95
+  FROM ttfb
+  GROUP BY session_id
+)
+SELECT
+  rr.session_id,
+  COUNT(*) AS total_requests,
+  SUM(rr.is_success) AS success_requests,
+  AVG(rr.is_success * 1.0) AS success_rate,
+  SUM(CASE WHEN rr.status_code BETWEEN 200 AND 299 THEN 1 ELSE 0 END) AS status_2xx,
+  SUM(CASE WHEN rr.status_code BETWEEN 400 AND 499 THEN 1 ELSE 0 END) AS status_4xx,
+  SUM(CASE WHEN rr.status_code BETWEEN 500 AND 599 THEN 1 ELSE 0 END) AS status_5xx,
+  AVG(rr.latency_ms) AS latency_avg,
+  lat_p.p95 AS latency_p95,
+  lat_p.p99 AS latency_p99,
+  AVG(rr.ttfb_ms) AS ttfb_avg,
+  ttfb_p.p95 AS ttfb_p95
+FROM rr
+LEFT JOIN lat_p ON lat_p.session_id = rr.session_id
+LEFT JOIN ttfb_p ON ttfb_p.session_id = rr.session_id
+GROUP BY rr.session_id
+"""
+
+_SQL_ENDPOINTS_LIVE = """
+WITH rr AS (
+  SELECT sj.session_id, r.endpoint, r.method, r.latency_ms, r.is_success, r.status_code
+  FROM analysis_session_jobs sj
+  JOIN request_results r ON r.job_id = sj.job_id
+  WHERE sj.session_id IN (SELECT value FROM json_each(?))
+),
+lat AS (
+  SELECT session_id, endpoint, method, latency_ms AS v,
+         ROW_NUMBER() OVER w - 1 AS rn,
+         COUNT(*) OVER (PARTITION BY session_id, endpoint, method) - 1 AS last
+  FROM rr
+  WHERE latency_ms IS NOT NULL
+  WINDOW w AS (PARTITION BY session_id, endpoint, method ORDER BY latency_ms)
+),
+lat_p AS (
+  SELECT session_id, endpoint, method,
+    SUM(CASE rn
+          WHEN CAST(last * 0.95 AS INTEGER) THEN v * (1 - (last * 0.95 - CAST(last * 0.95 AS INTEGER)))
+          WHEN CAST(last * 0.95 AS INTEGER) + 1 THEN v * (last * 0.95 - CAST(last * 0.95 AS INTEGER))
+        END) AS p95
+  FROM lat
+  GROUP BY session_id, endpoint, method
+)
+SELECT
+  rr.session_id,
+  rr.endpoint,
+  rr.method,
+  COUNT(*) AS count,
+  AVG(rr.is_success * 1.0) AS success_rate,
+  lat_p.p95 AS latency_p95,
+  SUM(CASE WHEN rr.status_code BETWEEN 500 AND 599 THEN 1 ELSE 0 END) AS status_5xx
+FROM rr
+LEFT JOIN lat_p
+  ON lat_p.session_id = rr.session_id AND lat_p.endpoint = rr.endpoint AND lat_p.method = rr.method
+GROUP BY rr.session_id, rr.endpoint, rr.method
+ORDER BY rr.session_id, latency_p95 DESC
+"""
+
+# bucket jak w aggregates_sessions: (ts_epoch / b) * b, UTC; p95 per bucket tylko w zmaterializowanych agregatach
+_SQL_TIMESERIES_LIVE = """
+SELECT
+  sj.session_id,
+  strftime('%Y-%m-%d %H:%M:%S', (r.ts_epoch / ?) * ?, 'unixepoch') AS bucket_start,
+  COUNT(*) AS count,
+  AVG(r.is_success * 1.0) AS success_rate,
+  SUM(CASE WHEN r.status_code BETWEEN 500 AND 599 THEN 1 ELSE 0 END) AS status_5xx,
+  AVG(r.latency_ms) AS latency_avg,
+  NULL AS latency_p95
+FROM analysis_session_jobs sj
+JOIN request_results r ON r.job_id = sj.job_id
+WHERE sj.session_id IN (SELECT value FROM json_each(?))
+  AND r.ts_epoch IS NOT NULL
+GROUP BY sj.session_id, bucket_start
+ORDER BY sj.session_id, bucket_start ASC
+"""
+
+
+def _fetch_by_session(con, sql, args=()):
+    """
+    Wiersze (sqlite3.Row, bez kopiowania do dict) pogrupowane po session_id;
+    kolejność w obrębie sesji jak w ORDER BY zapytania.
+    """
+    out = {}
+    for r in con.execute(sql, args):
+        out.setdefault(r["session_id"], []).append(r)
+    return out
 
 
-def _fetch_all(con, sql, args=()):
-    return [dict(r) for r in con.execute(sql, args).fetchall()]
+def _preload_sessions(con, session_ids, out_bucket_seconds: int):
+    """
+    Ładuje dane wszystkich sesji raportu jednym zapytaniem na tabelę (session_id IN json_each(?)).
+    Zwraca (sessions, summaries, endpoints, timeseries) jako dict[session_id, ...].
+    """
+    if not session_ids:
+        return {}, {}, {}, {}
+
+    ids = orjson.dumps(session_ids).decode()
+    sessions = _fetch_by_session(con, _SQL_SESSIONS, (ids,))
+    summaries = _fetch_by_session(con, _SQL_SUMMARY, (ids,))
+    eps = _fetch_by_session(con, _SQL_ENDPOINTS, (ids,))
+    ts = _fetch_by_session(con, _SQL_TIMESERIES, (ids, out_bucket_seconds))
+
+    # agregaty niepoliczone -> liczymy w SQLite z RAW tej sesji, zamiast pustej sekcji w raporcie
+    missing = [sid for sid in session_ids if sid in sessions and sid not in summaries]
+    if missing:
+        ids = orjson.dumps(missing).decode()
+        summaries.update(_fetch_by_session(con, _SQL_SUMMARY_LIVE, (ids,)))
+        eps.update(_fetch_by_session(con, _SQL_ENDPOINTS_LIVE, (ids,)))
+        ts.update(_fetch_by_session(con, _SQL_TIMESERIES_LIVE, (out_bucket_seconds, out_bucket_seconds, ids)))
+    return (
+        {sid: rows[0] for sid, rows in sessions.items()},
+        {sid: rows[0] for sid, rows in summaries.items()},
+        eps,
+        ts,
+    )
 
 
 def _normalize_session_ids(con, session_ids):
@@ -32,7 +232,7 @@ def _normalize_session_ids(con, session_ids):
       - list[int] => lista sesji
     """
     if session_ids is None or session_ids == []:
-        rows = con.execute("SELECT session_id FROM analysis_sessions ORDER BY session_id ASC").fetchall()
+        rows = con.execute(_SQL_ALL_SESSION_IDS).fetchall()
         return [int(r["session_id"]) for r in rows]
 
     if isinstance(session_ids, int):
@@ -41,26 +241,38 @@ def _normalize_session_ids(con, session_ids):
     return [int(x) for x in session_ids]
 
 
+# wspólny styl wszystkich tabel raportu (jedna instancja zamiast nowej przy każdej tabeli)
+_TABLE_STYLE = TableStyle(
+    [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+        ("FONTNAME", (0, 0), (-1, 0), "DejaVu-Bold"),
+        ("FONTNAME", (0, 1), (-1, -1), "DejaVu"),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.white]),
+        ("ALIGN", (0, 0), (-1, -1), "LEFT"),
+    ]
+)
+
+
 def _make_table(data, col_widths=None):
     tbl = Table(data, repeatRows=1, colWidths=col_widths)
-    tbl.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-                ("FONTNAME", (0, 0), (-1, 0), "DejaVu-Bold"),
-                ("FONTNAME", (0, 1), (-1, -1), "DejaVu"),
-                ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.white]),
-                ("ALIGN", (0, 0), (-1, -1), "LEFT"),
-            ]
-        )
-    )
+    tbl.setStyle(_TABLE_STYLE)
     return tbl
 
 
+def _ensure_fonts():
+    """
+    Rejestruje fonty DejaVu raz na proces (TTFont parsuje cały plik TTF z dysku).
+    """
+    registered = pdfmetrics.getRegisteredFontNames()
+    if "DejaVu" not in registered:
+        pdfmetrics.registerFont(TTFont("DejaVu", FONT))
+    if "DejaVu-Bold" not in registered:
+        pdfmetrics.registerFont(TTFont("DejaVu-Bold", FONT_BOLD))
+
+
 def _register_fonts(styles):
-    pdfmetrics.registerFont(TTFont("DejaVu", FONT))
-    pdfmetrics.registerFont(TTFont("DejaVu-Bold", FONT_BOLD))
+    _ensure_fonts()
 
     # Paragraphy
     styles["Normal"].fontName = "DejaVu"
@@ -69,53 +281,56 @@ def _register_fonts(styles):
     styles["Heading2"].fontName = "DejaVu-Bold"
 
 
+class _LazyStory(list):
+    """
+    Story dla doc.build dociągane porcjami (np. sesja po sesji) z iteratora list flowables.
+    doc.build zdejmuje flowables z początku listy i sprawdza len() w każdym kroku — tu len()
+    dokłada kolejną porcję, gdy lista się kończy. W pamięci są flowables 1-2 sesji, nie całego raportu.
+    Porcja powinna kończyć się PageBreak (keepWithNext nie przechodzi między porcjami).
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+
+    def __len__(self):
+        n = super().__len__()
+        while n < 2:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.extend(chunk)
+            n = super().__len__()
+        return n
+
+
 def _render_single_session(
     story,
-    con,
     styles,
     session_id: int,
-    out_bucket_seconds: int,
+    sess,
+    summ,
+    eps,
+    ts,
 ):
     """
-    Renderuje jedną sesję do istniejącego story.
+    Renderuje jedną sesję do istniejącego story z wcześniej załadowanych wierszy (_preload_sessions).
     Zakłada, że agregaty sesji są już policzone i siedzą w:
       - session_summary
       - session_endpoint_summary
-      - session_timeseries_summary
+      - session_timeseries_summary (już przefiltrowane po bucket_seconds)
     """
-    sess = _fetch_one(con, "SELECT * FROM analysis_sessions WHERE session_id=?", (session_id,))
     if not sess:
         story.append(Paragraph(f"Brak sesji session_id={session_id}", styles["Heading1"]))
         story.append(PageBreak())
         return
 
-    summ = _fetch_one(con, "SELECT * FROM session_summary WHERE session_id=?", (session_id,))
-    eps = _fetch_all(
-        con,
-        """
-        SELECT * FROM session_endpoint_summary
-        WHERE session_id=?
-        ORDER BY latency_p95 DESC
-        """,
-        (session_id,),
-    )
-    ts = _fetch_all(
-        con,
-        """
-        SELECT * FROM session_timeseries_summary
-        WHERE session_id=?
-          AND bucket_seconds=?
-        ORDER BY bucket_start ASC
-        """,
-        (session_id, out_bucket_seconds),
-    )
-
     # ===== Header sesji =====
     story.append(Paragraph(f"Sesja #{session_id}", styles["Heading1"]))
-    desc = sess.get("description") or ""
+    desc = sess["description"] or ""
     story.append(Paragraph(f"Opis: {desc}" if desc else "Opis: —", styles["Normal"]))
-    story.append(Paragraph(f"Start: {sess.get('started_at')} | Status: {sess.get('status')}", styles["Normal"]))
-    story.append(Paragraph(f"TotalDepth: {sess.get('total_depth')}", styles["Normal"]))
+    story.append(Paragraph(f"Start: {sess['started_at']} | Status: {sess['status']}", styles["Normal"]))
+    story.append(Paragraph(f"TotalDepth: {sess['total_depth']}", styles["Normal"]))
     story.append(Spacer(1, 4 * mm))
 
     # ===== Summary =====
@@ -126,6 +341,13 @@ def _render_single_session(
         story.append(PageBreak())
         return
 
+    if "latency_percentiles" in summ.keys():
+        _, _, lat_p95, lat_p99 = unpack_latency_percentiles(summ["latency_percentiles"])
+    else:
+        # wiersz z _SQL_SUMMARY_LIVE
+        lat_p95, lat_p99 = summ["latency_p95"], summ["latency_p99"]
+        story.append(Paragraph("Agregaty sesji niepoliczone — wartości wyliczone na żywo z RAW.", styles["Normal"]))
+
     summary_data = [
         ["Metryka", "Wartość"],
         ["Liczba żądań", summ["total_requests"]],
@@ -135,7 +357,7 @@ def _render_single_session(
         ],
         [
             "Latency avg / p95 / p99 (ms)",
-            f"{summ['latency_avg']:.2f} / {summ['latency_p95']:.2f} / {summ['latency_p99']:.2f}",
+            f"{summ['latency_avg']:.2f} / {lat_p95:.2f} / {lat_p99:.2f}",
         ],
         [
             "TTFB avg / p95 (ms)",
@@ -152,18 +374,19 @@ def _render_single_session(
     # ===== Endpoints =====
     story.append(Paragraph("2. Statystyki per endpoint (sesja)", styles["Heading2"]))
 
+    # wiersze budowane comprehension + formatowanie % (bez append i f-stringów per wiersz)
     ep_rows = [["Endpoint", "Method", "Count", "Success", "Latency p95 (ms)", "5xx"]]
-    for e in eps:
-        ep_rows.append(
-            [
-                e["endpoint"],
-                e["method"],
-                e["count"],
-                f"{e['success_rate']*100:.1f}%",
-                "-" if e["latency_p95"] is None else f"{e['latency_p95']:.2f}",
-                e["status_5xx"],
-            ]
-        )
+    ep_rows += [
+        [
+            e["endpoint"],
+            e["method"],
+            e["count"],
+            "%.1f%%" % (e["success_rate"] * 100),
+            "-" if e["latency_p95"] is None else "%.2f" % e["latency_p95"],
+            e["status_5xx"],
+        ]
+        for e in eps
+    ]
     story.append(_make_table(ep_rows))
     story.append(Spacer(1, 6 * mm))
 
@@ -171,17 +394,17 @@ def _render_single_session(
     story.append(Paragraph("3. Trend w czasie (overall, sesja)", styles["Heading2"]))
 
     ts_rows = [["Bucket start", "Count", "Success", "Latency avg", "Latency p95", "5xx"]]
-    for t in ts:
-        ts_rows.append(
-            [
-                t["bucket_start"],
-                t["count"],
-                f"{t['success_rate']*100:.1f}%",
-                "-" if t["latency_avg"] is None else f"{t['latency_avg']:.2f}",
-                "-" if t["latency_p95"] is None else f"{t['latency_p95']:.2f}",
-                t["status_5xx"],
-            ]
-        )
+    ts_rows += [
+        [
+            t["bucket_start"],
+            t["count"],
+            "%.1f%%" % (t["success_rate"] * 100),
+            "-" if t["latency_avg"] is None else "%.2f" % t["latency_avg"],
+            "-" if t["latency_p95"] is None else "%.2f" % t["latency_p95"],
+            t["status_5xx"],
+        ]
+        for t in ts
+    ]
     story.append(_make_table(ts_rows))
     story.append(PageBreak())
 
@@ -189,7 +412,7 @@ def _render_single_session(
 def generate_pdf_for_sessions(
     db_path: str,
     session_ids=None,  # int | list[int] | None
-    out_path: str = "raport_sesje.pdf",
+    out_path: str | BinaryIO = "raport_sesje.pdf",
     bucket_seconds: int = 10,
 ):
     """
@@ -199,14 +422,19 @@ def generate_pdf_for_sessions(
       - None albo [] => wszystkie sesje z analysis_sessions
       - int => jedna sesja
       - list[int] => wybrane sesje
+
+    out_path: ścieżka pliku albo obiekt plikopodobny (np. io.BytesIO)
     """
-    con = sqlite3.connect(db_path)
-    con.row_factory = sqlite3.Row
 
     styles = getSampleStyleSheet()
     _register_fonts(styles)
 
-    session_ids = _normalize_session_ids(con, session_ids)
+    # jeden spójny snapshot odczytu dla całego raportu (reader z puli procesu)
+    with get_pool(db_path).acquire_reader() as con:
+        con.execute("BEGIN")
+        session_ids = _normalize_session_ids(con, session_ids)
+        sessions, summaries, eps, ts = _preload_sessions(con, session_ids, bucket_seconds)
+        con.commit()
 
     doc = SimpleDocTemplate(
         out_path,
@@ -217,13 +445,23 @@ def generate_pdf_for_sessions(
         bottomMargin=15 * mm,
     )
 
-    story = []
+    # ===== Render each session (flowables sesji tworzone dopiero, gdy doc.build do nich dojdzie) =====
+    def session_chunks():
+        for sid in session_ids:
+            chunk = []
+            _render_single_session(
+                chunk, styles, sid,
+                sessions.get(sid), summaries.get(sid), eps.get(sid, []), ts.get(sid, []),
+            )
+            yield chunk
+
+    story = _LazyStory(session_chunks())
 
     # ===== Global title =====
     story.append(Paragraph("Raport wydajności — zestaw sesji", styles["Title"]))
     story.append(
         Paragraph(
-            f"Wygenerowano: {datetime.now().isoformat(timespec='seconds')} | "
+            f"Wygenerowano: {time.strftime('%Y-%m-%dT%H:%M:%S')} | "
             f"Sesje: {('wszystkie' if session_ids else 'brak')}",
             styles["Normal"],
         )
@@ -231,9 +469,13 @@ def generate_pdf_for_sessions(
     story.append(Spacer(1, 6 * mm))
     story.append(PageBreak())
 
-    # ===== Render each session =====
-    for sid in session_ids:
-        _render_single_session(story, con, styles, sid, bucket_seconds)
-
-    con.close()
     doc.build(story)
+
+
+def generate_pdf_bytes(db_path: str, session_ids=None, bucket_seconds: int = 10) -> bytes:
+    """
+    Jak generate_pdf_for_sessions, ale zwraca bajty PDF (np. wynik z procesu roboczego).
+    """
+    buf = io.BytesIO()
+    generate_pdf_for_sessions(db_path, session_ids, buf, bucket_seconds)
+    return buf.getvalue()
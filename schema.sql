@@ -4,6 +4,7 @@ CREATE TABLE IF NOT EXISTS request_results (
   job_id INTEGER NOT NULL,
   worker_id INTEGER NOT NULL,
   timestamp TEXT NOT NULL,          -- ISO 8601
+  ts_epoch INTEGER,                 -- timestamp jako epoch (s, UTC), liczony przy insercie
   method TEXT NOT NULL,
   endpoint TEXT NOT NULL,
   status_code INTEGER NOT NULL,
@@ -16,9 +17,15 @@ CREATE TABLE IF NOT EXISTS request_results (
   is_success INTEGER NOT NULL        -- 0/1
 );
 
-CREATE INDEX IF NOT EXISTS idx_rr_job ON request_results(job_id);
 CREATE INDEX IF NOT EXISTS idx_rr_job_ep ON request_results(job_id, endpoint, method);
 CREATE INDEX IF NOT EXISTS idx_rr_time ON request_results(timestamp);
+-- covering pod agregację sesji (JOIN po job_id bez sięgania do tabeli, bucket z ts_epoch);
+-- prefiks job_id obsługuje też zwykłe wyszukiwanie po job_id
+CREATE INDEX IF NOT EXISTS idx_rr_job_epoch_cover ON request_results(
+  job_id, latency_ms, ttfb_ms, status_code, is_success, endpoint, method, ts_epoch
+);
+-- starsze bazy: idx_rr_job zastąpiony przez idx_rr_job_epoch_cover
+DROP INDEX IF EXISTS idx_rr_job;
 
 -- 1) Sesja analizy (start batcha)
 CREATE TABLE IF NOT EXISTS analysis_sessions (
@@ -60,10 +67,7 @@ CREATE TABLE IF NOT EXISTS session_summary (
   status_5xx INTEGER NOT NULL,
 
   latency_avg REAL,
-  latency_p50 REAL,
-  latency_p90 REAL,
-  latency_p95 REAL,
-  latency_p99 REAL,
+  latency_percentiles BLOB,          -- struct '<4d': p50, p90, p95, p99 (db.pack_latency_percentiles)
 
   ttfb_avg REAL,
   ttfb_p95 REAL
@@ -100,5 +104,9 @@ CREATE TABLE IF NOT EXISTS session_timeseries_summary (
   PRIMARY KEY (session_id, bucket_seconds, bucket_start)
 );
 
-CREATE INDEX IF NOT EXISTS idx_sess_ep ON session_endpoint_summary(session_id);
-CREATE INDEX IF NOT EXISTS idx_sess_ts ON session_timeseries_summary(session_id, bucket_seconds, bucket_start);
+-- ORDER BY latency_p95 DESC w raporcie bez sortowania w temp b-tree (ts ma już PK)
+CREATE INDEX IF NOT EXISTS idx_sess_ep_p95 ON session_endpoint_summary(session_id, latency_p95 DESC);
+-- idx_sess_ep(session_id) to prefiks idx_sess_ep_p95
+DROP INDEX IF EXISTS idx_sess_ep;
+-- idx_sess_ts powielał PK (session_id, bucket_seconds, bucket_start) = sqlite_autoindex
+DROP INDEX IF EXISTS idx_sess_ts;
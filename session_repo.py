@@ -1,7 +1,9 @@
 import sqlite3
+from contextlib import nullcontext
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Iterable
+from typing import ContextManager, Iterable
+
+from db import ConnectionPool
 
 
 @dataclass(frozen=True)
@@ -21,15 +23,11 @@ class SessionRepository:
     Zakłada tabele:
       - analysis_sessions(session_id, started_at, description, total_depth, status)
       - analysis_session_jobs(session_id, job_id, depth)
+    Połączenia bierze z wstrzykniętej puli (zwykle db.get_pool(db_path)): zapis przez writera, odczyty przez readery.
     """
 
-    def __init__(self, db_path: str):
-        self.db_path = db_path
-
-    def _connect(self) -> sqlite3.Connection:
-        con = sqlite3.connect(self.db_path)
-        con.row_factory = sqlite3.Row
-        return con
+    def __init__(self, pool: ConnectionPool):
+        self._pool = pool
 
     # --- persist whole session at end ---
 
@@ -52,20 +50,18 @@ class SessionRepository:
         if not jobs_depth:
             raise ValueError("jobs_depth is empty - cannot create empty session")
 
-        con = self._connect()
-        try:
-            con.execute("BEGIN")
-
-            started = started_at or datetime.now().isoformat(timespec="seconds")
-
-            con.execute(
+        # BEGIN IMMEDIATE / commit / rollback robi acquire_writer()
+        with self._pool.acquire_writer() as con:
+            # RETURNING (SQLite >= 3.35): id w tym samym statemencie, bez last_insert_rowid()
+            # started_at=None -> czas lokalny liczony przez SQLite (format jak isoformat(timespec="seconds"))
+            session_id = int(con.execute(
                 """
                 INSERT INTO analysis_sessions(started_at, description, total_depth, status)
-                VALUES (?, ?, ?, ?)
+                VALUES (COALESCE(?, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')), ?, ?, ?)
+                RETURNING session_id
                 """,
-                (started, description, int(total_depth), status),
-            )
-            session_id = int(con.execute("SELECT last_insert_rowid()").fetchone()[0])
+                (started_at, description, int(total_depth), status),
+            ).fetchone()[0])
 
             rows = [(session_id, int(job_id), int(depth)) for job_id, depth in jobs_depth.items()]
             con.executemany(
@@ -76,22 +72,29 @@ class SessionRepository:
                 rows,
             )
 
-            con.commit()
-            return session_id
-
-        except Exception:
-            con.rollback()
-            raise
-        finally:
-            con.close()
+        return session_id
 
     # --- read helpers (pod PDF / debug) ---
+    # Każda metoda przyjmuje opcjonalne con: przy kilku odczytach naraz
+    #   with repo.reader() as con: repo.get_session(sid, con); repo.get_session_job_ids(sid, con)
+
+    def reader(self) -> ContextManager[sqlite3.Connection]:
+        """
+        Reader z puli do użycia przez kilka wywołań get_* (jedno połączenie zamiast kilku).
+        """
+        return self._pool.acquire_reader()
+
+    def _reading(self, con: sqlite3.Connection | None) -> ContextManager[sqlite3.Connection]:
+        return nullcontext(con) if con is not None else self._pool.acquire_reader()
 
-    def get_session(self, session_id: int) -> Session | None:
-        con = self._connect()
-        try:
+    def get_session(self, session_id: int, con: sqlite3.Connection | None = None) -> Session | None:
+        with self._reading(con) as con:
             row = con.execute(
-                "SELECT * FROM analysis_sessions WHERE session_id=?",
+                """
+                SELECT session_id, started_at, description, total_depth, status
+                FROM analysis_sessions
+                WHERE session_id=?
+                """,
                 (int(session_id),),
             ).fetchone()
             if not row:
@@ -103,13 +106,13 @@ class SessionRepository:
                 total_depth=int(row["total_depth"]),
                 status=str(row["status"]),
             )
-        finally:
-            con.close()
 
-    def get_session_job_depths(self, session_id: int) -> dict[int, int]:
-        con = self._connect()
-        try:
-            rows = con.execute(
+    def get_session_job_depths(self, session_id: int, con: sqlite3.Connection | None = None) -> dict[int, int]:
+        with self._reading(con) as con:
+            # krotki (job_id, depth) zamiast sqlite3.Row -> dict(cursor) bez pracy per wiersz w Pythonie
+            cur = con.cursor()
+            cur.row_factory = None
+            cur.execute(
                 """
                 SELECT job_id, depth
                 FROM analysis_session_jobs
@@ -117,18 +120,24 @@ class SessionRepository:
                 ORDER BY job_id ASC
                 """,
                 (int(session_id),),
-            ).fetchall()
-            return {int(r["job_id"]): int(r["depth"]) for r in rows}
-        finally:
-            con.close()
+            )
+            return dict(cur)
 
-    def get_session_job_ids(self, session_id: int) -> list[int]:
-        con = self._connect()
-        try:
+    def get_session_job_ids(self, session_id: int, con: sqlite3.Connection | None = None) -> list[int]:
+        with self._reading(con) as con:
             rows = con.execute(
                 "SELECT job_id FROM analysis_session_jobs WHERE session_id=? ORDER BY job_id ASC",
                 (int(session_id),),
             ).fetchall()
             return [int(r["job_id"]) for r in rows]
-        finally:
-            con.close()
+
+    def get_session_bundle(self, session_id: int) -> tuple[Session | None, dict[int, int]]:
+        """
+        Sesja + {job_id: depth} na jednym połączeniu, w jednym snapshocie odczytu.
+        """
+        with self.reader() as con:
+            con.execute("BEGIN")
+            session = self.get_session(session_id, con)
+            depths = self.get_session_job_depths(session_id, con) if session else {}
+            con.commit()
+            return session, depths
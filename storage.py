@@ -1,6 +1,9 @@
 import sqlite3
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Mapping
+from typing import Any, Iterable, Mapping
+
+from db import get_pool, open_conn, pack_latency_percentiles
 
 REQUIRED_KEYS = {
     "job_id", "worker_id", "timestamp",
@@ -10,48 +13,128 @@ REQUIRED_KEYS = {
     "scenario_step", "is_success",
 }
 
+# kolejność kolumn: pola DTO + ts_epoch na końcu (wspólne z job_repo.JobRepository)
+INSERT_SQL = """
+INSERT INTO request_results(
+  job_id, worker_id, timestamp,
+  method, endpoint, status_code,
+  latency_ms, ttfb_ms,
+  response_size_bytes, error_msg,
+  scenario_step, is_success,
+  ts_epoch
+)
+VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+def to_epoch_seconds(timestamp: str) -> int:
+    """
+    ISO 8601 -> epoch w sekundach. Brak strefy = UTC (tak samo jak strftime('%s', ...) w SQLite).
+    """
+    dt = datetime.fromisoformat(timestamp)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def _migrate(con: sqlite3.Connection) -> None:
+    """
+    Dociąga starsze bazy do aktualnego schema.sql (CREATE TABLE IF NOT EXISTS nie dodaje kolumn).
+    Woła się w jawnej transakcji (init_db).
+    """
+    cols = {r[1] for r in con.execute("PRAGMA table_info(request_results)").fetchall()}
+    if cols and "ts_epoch" not in cols:
+        con.execute("ALTER TABLE request_results ADD COLUMN ts_epoch INTEGER")
+        con.execute(
+            "UPDATE request_results SET ts_epoch = CAST(strftime('%s', timestamp) AS INTEGER) "
+            "WHERE ts_epoch IS NULL"
+        )
+
+    cols = {r[1] for r in con.execute("PRAGMA table_info(session_summary)").fetchall()}
+    if cols and "latency_percentiles" not in cols:
+        con.execute("ALTER TABLE session_summary ADD COLUMN latency_percentiles BLOB")
+        rows = con.execute(
+            "SELECT session_id, latency_p50, latency_p90, latency_p95, latency_p99 FROM session_summary"
+        ).fetchall()
+        con.executemany(
+            "UPDATE session_summary SET latency_percentiles=? WHERE session_id=?",
+            [(pack_latency_percentiles(*r[1:]), r[0]) for r in rows],
+        )
+
+
 def init_db(db_path: str, schema_path: str = "schema.sql") -> None:
     Path(db_path).parent.mkdir(parents=True, exist_ok=True)
-    con = sqlite3.connect(db_path)
+    con = open_conn(db_path)
     try:
+        con.execute("BEGIN")
+        try:
+            _migrate(con)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
         with open(schema_path, "r", encoding="utf-8") as f:
             con.executescript(f.read())
-        con.commit()
     finally:
         con.close()
 
-def insert_raw_result(db_path: str, dto: Mapping[str, Any]) -> None:
-    missing = REQUIRED_KEYS - set(dto.keys())
+def _row_tuple(dto: Mapping[str, Any]) -> tuple:
+    missing = REQUIRED_KEYS - dto.keys()
     if missing:
         raise ValueError(f"Missing keys in dto: {sorted(missing)}")
 
-    con = sqlite3.connect(db_path)
+    return (
+        int(dto["job_id"]),
+        int(dto["worker_id"]),
+        str(dto["timestamp"]),
+        str(dto["method"]),
+        str(dto["endpoint"]),
+        int(dto["status_code"]),
+        float(dto["latency_ms"]),
+        (float(dto["ttfb_ms"]) if dto["ttfb_ms"] is not None else None),
+        int(dto["response_size_bytes"]),
+        (str(dto["error_msg"]) if dto["error_msg"] is not None else None),
+        int(dto["scenario_step"]),
+        1 if bool(dto["is_success"]) else 0,
+        to_epoch_seconds(str(dto["timestamp"])),
+    )
+
+
+def insert_raw_results(con: sqlite3.Connection, rows: Iterable[tuple]) -> None:
+    """
+    Zapisuje paczkę gotowych krotek (kolejność kolumn jak INSERT_SQL) jednym executemany
+    w JEDNEJ transakcji, bez walidacji i rzutowań. Błąd w którymkolwiek wierszu -> rollback całej paczki.
+    - con w transakcji (np. `with get_pool(db_path).acquire_writer() as con:`): pisze w niej,
+      commit / rollback robi wołający
+    - con bez transakcji (open_conn = autocommit): sam otwiera BEGIN IMMEDIATE i commituje,
+      więc paczka nigdy nie idzie commitem per wiersz
+    Krotki typowane produkuje wytwórca (np. job_repo.JobDTO -> _row_from_struct).
+    """
+    if con.in_transaction:
+        con.executemany(INSERT_SQL, rows)
+        return
+
+    con.execute("BEGIN IMMEDIATE")
     try:
-        con.execute(
-            """
-            INSERT INTO request_results (
-              job_id, worker_id, timestamp,
-              method, endpoint, status_code,
-              latency_ms, ttfb_ms,
-              response_size_bytes, error_msg,
-              scenario_step, is_success
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (
-                int(dto["job_id"]),
-                int(dto["worker_id"]),
-                str(dto["timestamp"]),
-                str(dto["method"]),
-                str(dto["endpoint"]),
-                int(dto["status_code"]),
-                float(dto["latency_ms"]),
-                (float(dto["ttfb_ms"]) if dto["ttfb_ms"] is not None else None),
-                int(dto["response_size_bytes"]),
-                (str(dto["error_msg"]) if dto["error_msg"] is not None else None),
-                int(dto["scenario_step"]),
-                1 if bool(dto["is_success"]) else 0,
-            ),
-        )
+        con.executemany(INSERT_SQL, rows)
         con.commit()
-    finally:
-        con.close()
+    except BaseException:
+        con.rollback()
+        raise
+
+
+def insert_raw_results_from_dicts(con: sqlite3.Connection, dtos: Iterable[Mapping[str, Any]]) -> None:
+    """
+    Jak insert_raw_results (ta sama gwarancja jednej transakcji), ale dla surowych dictów
+    (walidacja kluczy + rzutowanie per wiersz).
+    """
+    insert_raw_results(con, map(_row_tuple, dtos))
+
+
+def insert_raw_result(db_path: str, dto: Mapping[str, Any]) -> None:
+    """
+    Wsteczna kompatybilność: pojedynczy wiersz przez writera z puli procesu.
+    W pętlach używać JobRepository (paczka = jedna transakcja writera).
+    """
+    row = _row_tuple(dto)
+    with get_pool(db_path).acquire_writer() as con:
+        insert_raw_results(con, [row])